@@ -65,6 +65,16 @@ def parse_args() -> argparse.Namespace:
         help="PanelApp JSON dump"
     )
 
+    parser.add_argument(
+        '-c',
+        '--check_counts',
+        action='store_true',
+        help=(
+            "Count variants before splitting and after filtering to check "
+            "none are lost (adds two extra passes over the VCF)"
+        )
+    )
+
     args = parser.parse_args()
 
     return args
@@ -109,7 +119,8 @@ def main():
         panels_from_string, args.genepanels, args.panel_dump
     )
     vcf.add_annotation(
-        args.input_vcf, panel_dict, bcftools_filter_command
+        args.input_vcf, panel_dict, bcftools_filter_command,
+        args.check_counts
     )
 
 
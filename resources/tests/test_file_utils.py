@@ -0,0 +1,58 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.realpath(__file__), '../../')
+))
+
+from utils import file_utils
+
+
+class TestReadInJSON():
+    """
+    Test the read_in_json function which parses a JSON file into a dict
+    """
+    test_panel_dump = [{
+        'panel_source': 'PanelApp',
+        'panel_name': 'Stickler syndrome',
+        'external_id': '3',
+        'panel_version': '4.0',
+        'genes': [{
+            'hgnc_id': 'HGNC:1071',
+            'confidence_level': '3',
+            'mode_of_inheritance': (
+                'MONOALLELIC, autosomal or pseudoautosomal, imprinted '
+                'status unknown'
+            ),
+            'penetrance': None,
+            'gene_symbol': 'BMP4'
+        }],
+        'regions': []
+    }]
+
+    def test_read_in_json(self, tmp_path):
+        """
+        Check JSON is parsed correctly, including nulls, nesting and
+        non-ASCII characters
+        """
+        test_json = tmp_path / 'test.json'
+        test_json.write_text(
+            '{"panel": "Sjögren syndrome", "genes": [{"moi": null}]}',
+            encoding='utf8'
+        )
+
+        assert file_utils.read_in_json(test_json) == {
+            'panel': 'Sjögren syndrome',
+            'genes': [{'moi': None}]
+        }, "JSON not parsed correctly into dict"
+
+    def test_read_in_json_reads_written_out_json(self, tmp_path):
+        """
+        Check a JSON written out with write_out_json is read back in unchanged
+        """
+        test_json = tmp_path / 'test.json'
+        file_utils.write_out_json(test_json, self.test_panel_dump)
+
+        assert file_utils.read_in_json(test_json) == self.test_panel_dump, (
+            "JSON read in does not match the JSON written out"
+        )
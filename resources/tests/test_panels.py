@@ -52,6 +52,23 @@ class TestParseGenePanels():
         with pytest.raises(AssertionError, match=expected_error):
             panels.parse_genepanels(self.genepanels_tsv2)
 
+    @pytest.mark.parametrize("bad_line", [
+        'R1.1_Test_P\tTest panel_1.0\tHGNC:1\n',
+        'R1.1_Test_P\tTest panel_1.0\tHGNC:1\t53\textra\n'
+    ])
+    def test_parse_genepanels_when_line_has_wrong_number_of_columns(
+            self, tmp_path, bad_line
+        ):
+        """
+        Check raises error rather than taking the wrong column as the panel
+        ID when a line is not in the four column format
+        """
+        genepanels_tsv = tmp_path / 'genepanels.tsv'
+        genepanels_tsv.write_text(bad_line)
+
+        with pytest.raises(ValueError, match='does not have 4'):
+            panels.parse_genepanels(genepanels_tsv)
+
 
 class TestGetPanelIDFromGenePanels():
     """
@@ -276,6 +293,22 @@ class TestTransformPanelAppDumpToDict():
                 " key is missing"
         )
 
+    def test_transform_panelapp_dump_to_dict_when_first_panel_has_no_id(
+        self
+    ):
+        """
+        Make sure that panels are still keyed by their own ID when a panel
+        with no external ID comes before them in the dump
+        """
+        panel_dump = list(reversed(self.test_panel_dump))
+
+        panel_id_dict = panels.transform_panelapp_dump_to_dict(panel_dump)
+
+        assert panel_id_dict['9']['external_id'] == '9', (
+            "PanelApp dict keyed incorrectly when a panel without an "
+            "external_id key comes first"
+        )
+
     def test_transform_panelapp_dump_to_dict_when_no_panels_left(self):
         """
         Make sure that error raised if no panels are left after transforming
@@ -612,6 +645,10 @@ class TestSimplifyMOITerms():
         'gene17': {
             'mode_of_inheritance': 'MOI we havent thought of',
             'entity_type': 'gene'
+        },
+        'gene18': {
+            'mode_of_inheritance': '',
+            'entity_type': 'gene'
         }
     }
 
@@ -620,7 +657,8 @@ class TestSimplifyMOITerms():
     def test_simplify_MOI_terms(self):
         """
         Check simplify_MOI_terms function takes dict and simplifies the
-        PanelApp MOI terms simplified correctly, including when MOI is None
+        PanelApp MOI terms simplified correctly, including when MOI is None or
+        empty
         """
         assert panels.simplify_MOI_terms(self.test_gene_dict) == {
             'gene1': {'mode_of_inheritance': 'AR'},
@@ -639,7 +677,8 @@ class TestSimplifyMOITerms():
             'gene14': {'mode_of_inheritance': 'UNKNOWN'},
             'gene15': {'mode_of_inheritance': 'XLR'},
             'gene16': {'mode_of_inheritance': 'XLD'},
-            'gene17': {'mode_of_inheritance': 'NONE'}
+            'gene17': {'mode_of_inheritance': 'NONE'},
+            'gene18': {'mode_of_inheritance': 'NONE'}
         }, "MOIs not simplified correctly"
 
     def test_simplify_MOI_terms_if_dict_is_none(self):
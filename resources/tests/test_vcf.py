@@ -1,10 +1,14 @@
 import os
 import pytest
+import subprocess
 import sys
+import tempfile
 import unittest
 
 from pathlib import Path
-from unittest.mock import Mock, patch
+from unittest.mock import patch
+
+from pysam import VariantFile
 
 sys.path.append(os.path.abspath(
     os.path.join(os.path.realpath(__file__), '../../')
@@ -27,48 +31,6 @@ TEST_FLAGGED_VCF = (
     "Haplotyper_annotated.flagged_test.vcf"
 )
 
-TEST_TRUNCATED_VCF = (
-    "126560840-23326Q0015-23NGWES4-9526-F-103698_markdup_recalibrated_"
-    "Haplotyper_annotated.flagged_truncated.vcf"
-)
-
-
-class TestBgzip(unittest.TestCase):
-    """
-    Test the function which uses subprocess to bgzip a file
-    """
-    annotated_split_vcf = os.path.join(TEST_DATA_DIR, TEST_SPLIT_VCF)
-
-    def test_bgzip_output_file_exists(self):
-        """
-        Test that gzipped output file exists
-        """
-        vcf.bgzip(self.annotated_split_vcf)
-        assert os.path.exists(
-            os.path.join(
-                TEST_DATA_DIR,
-                "126560840-23326Q0015-23NGWES4-9526-F-103698_markdup_"
-                "recalibrated_Haplotyper_annotated.split_test.vcf.gz"
-            )
-        ), "gzipped file does not exist"
-
-        # Remove the gzipped VCF
-        os.remove(os.path.join(
-            TEST_DATA_DIR,
-            "126560840-23326Q0015-23NGWES4-9526-F-103698_markdup_"
-            "recalibrated_Haplotyper_annotated.split_test.vcf.gz"
-        ))
-
-    @patch('utils.vcf.subprocess.run')
-    def test_bgzip_raises_error_if_return_code_not_zero(self, mock_vcf):
-        """
-        Test assertion error raised if return code of bgzip not zero
-        """
-        mock_vcf.return_value.returncode = 1
-
-        with pytest.raises(AssertionError):
-            vcf.bgzip(mock_vcf)
-
 
 class TestBcftoolsPreProcess():
     """
@@ -77,68 +39,61 @@ class TestBcftoolsPreProcess():
     """
     annotated_vcf = os.path.join(TEST_DATA_DIR, TEST_ANNOTATED_VCF)
 
-    def test_bcftools_pre_process_variant_count(self, capsys):
+    def test_bcftools_pre_process_streams_all_variants(self):
         """
-        Test variant counts before and after bcftools +split-vep
-        are printed as expected
+        Test all variants are streamed to stdout by bcftools +split-vep,
+        with the CSQ string split out into separate INFO fields
         """
-        output_vcf = vcf.bcftools_pre_process(self.annotated_vcf)
-        stdout = capsys.readouterr().out
+        with tempfile.TemporaryFile() as log:
+            processes = vcf.bcftools_pre_process(self.annotated_vcf, log)
+            split_contents = VariantFile(processes[-1].stdout)
+            split_variants = list(split_contents)
+            processes[-1].stdout.close()
+            for process in processes:
+                vcf.check_process(process, log, 'bcftools +split-vep')
 
         errors = []
-        if not 'Total lines before splitting: 255' in stdout:
+        if not len(split_variants) == 255:
             errors.append(
-                "Variant counts pre-split not included in stdout as expected"
-            )
-        if not 'Total lines after splitting: 255' in stdout:
-            errors.append(
-                "Variant counts after split not included in stdout as expected"
-            )
-        if not output_vcf == (
-            '126560840-23326Q0015-23NGWES4-9526-F-103698_markdup_recalibrated'
-            '_Haplotyper_annotated.split.vcf'
-        ):
-            errors.append(
-                "Output VCF from bcftools_pre_process not named as expected"
+                "Variant count after split not the 255 expected"
             )
+        if 'CSQ' in split_contents.header.info:
+            errors.append("Original CSQ INFO field not removed")
+        if 'CSQ_SYMBOL' not in split_contents.header.info:
+            errors.append("CSQ fields not split to separate INFO fields")
 
         assert not errors, (
             "Errors occurred with the output of bcftools_preprocess"
             "():\n{}".format("\n".join(errors))
         )
 
-        os.remove(
-            '126560840-23326Q0015-23NGWES4-9526-F-103698_markdup_recalibrated'
-            '_Haplotyper_annotated.split.vcf'
-        )
 
-    @patch('utils.vcf.subprocess.run')
-    def test_bcftools_pre_process_raises_error_if_return_code_not_zero(
-            self, mock_vcf
-    ):
+class TestCheckProcess():
+    """
+    Test the function which checks a streaming subprocess exited
+    successfully
+    """
+    def test_check_process_raises_error_if_return_code_not_zero(self):
         """
-        Test bcftools pre-process function which splits VEP vcf
-        raises assertion error if return code not zero
+        Test assertion error raised, including the stderr of the process,
+        if return code not zero
         """
-        mock_vcf.return_value.returncode = 124
+        with tempfile.TemporaryFile() as log:
+            process = subprocess.Popen(
+                "echo 'Error: test' >&2; exit 124", shell=True, stderr=log
+            )
 
-        with pytest.raises(AssertionError):
-            vcf.bcftools_pre_process(mock_vcf)
+            with pytest.raises(AssertionError, match='Error: test'):
+                vcf.check_process(process, log, 'test process')
 
-    @patch('utils.vcf.subprocess.run')
-    def test_bcftools_pre_process_raises_error_if_variants_lost(
-        self, mock_subprocess
-    ):
+    def test_check_process_does_not_raise_error_if_return_code_zero(self):
         """
-        Test assertion error raised if variant are lost following bcftools
-        +split-vep
+        Test no error raised if return code of the process is zero
         """
-        mock_subprocess.side_effect = [
-            Mock(stdout=b'14'), Mock(returncode=0), Mock(stdout=b'5')
-        ]
+        with tempfile.TemporaryFile() as log:
+            process = subprocess.Popen("exit 0", shell=True, stderr=log)
 
-        with pytest.raises(AssertionError):
-            vcf.bcftools_pre_process('mock_vcf')
+            vcf.check_process(process, log, 'test process')
 
 
 class TestReadInVCF():
@@ -176,6 +131,24 @@ class TestReadInVCF():
             '"Mode of inheritance from PanelApp (simplified)"', '131'
         ] in vcf_header_items, "MOI not added to header correctly"
 
+    def test_read_in_vcf_with_existing_moi_header(self):
+        """
+        Test that a VCF which already has the MOI INFO tag is read in without
+        the header line being added a second time
+        """
+        vcf_contents, _ = vcf.read_in_vcf(
+            os.path.join(TEST_DATA_DIR, TEST_FLAGGED_VCF)
+        )
+
+        moi_header_lines = [
+            record for record in vcf_contents.header.records
+            if record.get('ID') == 'MOI'
+        ]
+
+        assert len(moi_header_lines) == 1, (
+            "MOI header line duplicated when already present in VCF"
+        )
+
 
 class TestAddMOIFlag():
     """
@@ -187,7 +160,9 @@ class TestAddMOIFlag():
 
     test_panel_dict = {'POMC': {'mode_of_inheritance': 'AR'}}
 
-    gene_variant_dict = vcf.add_MOI_field(vcf_contents, test_panel_dict)
+    flagged_variants = list(
+        vcf.add_MOI_field(vcf_contents, test_panel_dict)
+    )
 
     def test_add_MOI_check_MOI_added_correctly_for_present_gene(self):
         """
@@ -195,7 +170,8 @@ class TestAddMOIFlag():
         have 'AR' as their MOI
         """
         assert [
-            record.info['MOI'] for record in self.gene_variant_dict.get('POMC')
+            record.info['MOI'] for record in self.flagged_variants
+            if record.info['CSQ_SYMBOL'][0] == 'POMC'
         ] == [('AR', ), ('AR',)], (
             "MOI not added correctly as AR for the two variants in POMC"
         )
@@ -205,20 +181,35 @@ class TestAddMOIFlag():
         Assert that variants in all other genes not in the panel dict
         have MOI INFO field added as 'NONE'
         """
-        all_mois_not_in_panel_dict = []
-        for gene, variant_list in self.gene_variant_dict.items():
-            if gene != 'POMC':
-                all_mois_for_gene = [
-                    variant.info['MOI'] for variant in variant_list
-                ]
-                all_mois_not_in_panel_dict.append(all_mois_for_gene)
+        all_mois_not_in_panel_dict = [
+            variant.info['MOI'] for variant in self.flagged_variants
+            if variant.info['CSQ_SYMBOL'][0] != 'POMC'
+        ]
 
-        assert all(('NONE',) for moi in all_mois_not_in_panel_dict)
+        assert all(moi == ('NONE',) for moi in all_mois_not_in_panel_dict)
+
+    def test_add_MOI_keeps_variants_in_input_order(self):
+        """
+        Assert that all variants are returned in the same (sorted) order
+        they were read in, so the flagged VCF does not need re-sorting
+        """
+        positions = [
+            (variant.chrom, variant.pos) for variant in self.flagged_variants
+        ]
+        original_positions = [
+            (variant.chrom, variant.pos) for variant in VariantFile(
+                os.path.join(TEST_DATA_DIR, TEST_SPLIT_VCF)
+            )
+        ]
+
+        assert positions == original_positions, (
+            "Variants not returned in the order they were read in"
+        )
 
 
 class TestWriteOutFlaggedVCF():
     """
-    Test writing out the pysam object as a VCF file works as expected
+    Test writing out the pysam object as a BCF file works as expected
     """
     vcf_contents, _ = vcf.read_in_vcf(
         os.path.join(TEST_DATA_DIR, TEST_SPLIT_VCF)
@@ -228,185 +219,247 @@ class TestWriteOutFlaggedVCF():
 
     flagged_vcf = (
         '126560840-23326Q0015-23NGWES4-9526-F-103698_markdup_recalibrated'
-        '_Haplotyper_annotated.flagged.vcf'
+        '_Haplotyper_annotated.flagged.bcf'
     )
 
-    gene_variant_dict = vcf.add_MOI_field(vcf_contents, test_panel_dict)
+    flagged_variants = list(
+        vcf.add_MOI_field(vcf_contents, test_panel_dict)
+    )
 
     def test_write_out_flagged_vcf(self):
         """
-        Test that the write_out_flagged_vcf function creates a flagged VCF file
-        as expected
+        Test that the write_out_flagged_vcf function creates a flagged BCF file
+        containing all of the variants as expected
         """
-        vcf.write_out_flagged_vcf(
-            self.flagged_vcf, self.gene_variant_dict, self.vcf_contents
+        total = vcf.write_out_flagged_vcf(
+            self.flagged_vcf, self.flagged_variants, self.vcf_contents
         )
 
-        assert os.path.exists(self.flagged_vcf)
-
+        written_vcf = VariantFile(self.flagged_vcf)
+        written_format = written_vcf.format
+        written_total = len(list(written_vcf))
         os.remove(self.flagged_vcf)
 
+        assert written_format == 'BCF' and written_total == total == 255, (
+            "Flagged variants not written out as BCF as expected"
+        )
+
 
-class TestCheckWrittenOutVcf():
+class TestBcftoolsFilter(unittest.TestCase):
     """
-    Test that the test_check_written_out_vcf() function which checks that the
-    pysam header and variants written to file match what was given to the
-    function to write out (i.e. the file is not truncated)
+    Test the function which uses subprocess to run bcftools filtering
     """
-    # Read in control VCF which has had CSQ fields expanded by bcftools
-    # +split-vep
-    original_vcf_contents, _ = vcf.read_in_vcf(
-        os.path.join(TEST_DATA_DIR, TEST_SPLIT_VCF)
+    flagged_vcf = os.path.join(TEST_DATA_DIR, TEST_FLAGGED_VCF)
+    filter_command = (
+        "bcftools filter --soft-filter \"EXCLUDE\" -m + "
+        "-e '(CSQ_Consequence~\"synonymous_variant\")'"
     )
-    # Create a test gene panel dict for obesity for adding MOI info to
-    # variants
-    test_panel_dict = {
-        'ALMS1': {'mode_of_inheritance': 'AR'},
-        'ARL6': {'mode_of_inheritance': 'AR'},
-        'BBS1': {'mode_of_inheritance': 'AR'},
-        'BBS10': {'mode_of_inheritance': 'AR'},
-        'BBS12': {'mode_of_inheritance': 'AR'},
-        'BBS2': {'mode_of_inheritance': 'AR'},
-        'BBS4': {'mode_of_inheritance': 'AR'},
-        'BBS5': {'mode_of_inheritance': 'AR'},
-        'BBS7': {'mode_of_inheritance': 'AR'},
-        'BBS9': {'mode_of_inheritance': 'AR'},
-        'CEP19': {'mode_of_inheritance': 'AR'},
-        'CPE': {'mode_of_inheritance': 'AR'},
-        'GNAS': {'mode_of_inheritance': 'AD'},
-        'KIDINS220': {'mode_of_inheritance': 'AD'},
-        'LEP': {'mode_of_inheritance': 'AR'},
-        'LEPR': {'mode_of_inheritance': 'AR'},
-        'MC4R': {'mode_of_inheritance': 'AD/AR'},
-        'MKKS': {'mode_of_inheritance': 'AR'},
-        'MKS1': {'mode_of_inheritance': 'AR'},
-        'MYT1L': {'mode_of_inheritance': 'AD'},
-        'NTRK2': {'mode_of_inheritance': 'AD'},
-        'PCSK1': {'mode_of_inheritance': 'AR'},
-        'PGM2L1': {'mode_of_inheritance': 'AR'},
-        'PHF6': {'mode_of_inheritance': 'XLD'},
-        'PHIP': {'mode_of_inheritance': 'AD'},
-        'POMC': {'mode_of_inheritance': 'AR'},
-        'SDCCAG8': {'mode_of_inheritance': 'AR'},
-        'SIM1': {'mode_of_inheritance': 'AD'},
-        'TTC8': {'mode_of_inheritance': 'AR'},
-        'VPS13B': {'mode_of_inheritance': 'AR'},
-        '15q11q13 recurrent (PWS/AS) region (BP1-BP3, Class 1) Loss': {
-            'mode_of_inheritance': 'AD'
-        },
-        '15q11q13 recurrent (PWS/AS) region (BP2-BP3, Class 2) Loss': {
-            'mode_of_inheritance': 'AD'
-        },
-        (
-            '16p11.2 recurrent region (includes SH2B1) (distal region) '
-            '(BP2-BP3) Loss'
-        ): {'mode_of_inheritance': 'AD'}
-    }
-
-    gene_variant_dict = vcf.add_MOI_field(
-        original_vcf_contents, test_panel_dict
+    filter_vcf = (
+        f"{Path(flagged_vcf).stem.split('.')[0]}.optimised_filtered.vcf.gz"
     )
-    # This VCF has one variant removed from the end
-    truncated_vcf = os.path.join(TEST_DATA_DIR, TEST_TRUNCATED_VCF)
 
-    def test_check_written_out_vcf_raises_error(self):
+    def test_bcftools_filter_creates_file(self):
         """
-        Test error is raised if VCF which was written out which is different/
-        truncated compared to what was supposed to be written out
+        Test that bcftools filter output file exists when a VCF is streamed
+        to it
         """
-        with pytest.raises(AssertionError):
-            vcf.check_written_out_vcf(
-                self.original_vcf_contents,
-                self.gene_variant_dict,
-                self.truncated_vcf
+        with tempfile.TemporaryFile() as log:
+            process = vcf.bcftools_filter(
+                self.filter_command, self.filter_vcf, log
             )
+            with open(self.flagged_vcf, 'rb') as flagged:
+                process.stdin.write(flagged.read())
+            process.stdin.close()
+            vcf.check_process(process, log, 'bcftools filter')
 
+        # Check exists
+        assert os.path.exists(
+            self.filter_vcf
+        ), "bcftools filter output file does not exist"
 
-class TestBCftoolsSort(unittest.TestCase):
+        # Remove file so doesn't affect test if run again in future
+        os.remove(self.filter_vcf)
+
+
+class TestAddAnnotation():
     """
-    Test that bcftools sort works as expected
+    Test the main function which streams the VCF through splitting,
+    flagging and filtering
     """
-    @patch('utils.vcf.subprocess.run')
-    def test_bcftools_sort_raises_error_if_return_code_not_zero(
-        self, mock_subprocess
-    ):
+    split_vcf = os.path.join(TEST_DATA_DIR, TEST_SPLIT_VCF)
+    test_panel_dict = {'POMC': {'mode_of_inheritance': 'AR'}}
+    output_vcf = 'test.optimised_filtered.vcf.gz'
+
+    def stream_split_vcf(self, input_vcf, log):
         """
-        Test assertion error raised if return code of bcftools sort not zero
+        Stand in for bcftools +split-vep which streams the already split
+        test VCF
         """
-        mock_subprocess.return_value.returncode = 2
+        return [
+            subprocess.Popen(
+                ['cat', self.split_vcf], stdout=subprocess.PIPE, stderr=log
+            )
+        ]
 
-        with pytest.raises(AssertionError):
-            vcf.bcftools_sort('input_vcf')
+    def write_streamed_vcf(self, filter_command, filter_vcf, log):
+        """
+        Stand in for bcftools filter which writes the streamed VCF to file
+        """
+        return subprocess.Popen(
+            ['cp', '/dev/stdin', filter_vcf], stdin=subprocess.PIPE,
+            stderr=log
+        )
 
-    @patch('utils.vcf.subprocess.run')
-    def test_bcftools_sort_raises_error_if_variant_counts_not_match(
-        self, mock_subprocess
-    ):
+    def stream_large_split_vcf(self, input_vcf, log):
         """
-        Test assertion error raised if variant counts pre- and post-bcftools
-        sort do not match
+        Stand in for bcftools +split-vep which streams a split VCF large
+        enough to fill the pipe
         """
-        mock_subprocess.side_effect = [
-            Mock(stdout=b'14'), Mock(returncode=0), Mock(stdout=b'5')
+        return [
+            subprocess.Popen(
+                ['cat', self.large_split_vcf], stdout=subprocess.PIPE,
+                stderr=log
+            )
         ]
 
-        with pytest.raises(AssertionError):
-            vcf.bcftools_sort('flagged_vcf')
-
+    def fail_filter(self, filter_command, filter_vcf, log):
+        """
+        Stand in for bcftools filter which exits straight away with an
+        error, as for an invalid filter expression
+        """
+        return subprocess.Popen(
+            "echo 'Error: could not parse the expression' >&2; exit 255",
+            shell=True, stdin=subprocess.PIPE, stderr=log
+        )
 
-class TestBcftoolsFilter(unittest.TestCase):
-    """
-    Test the function which uses subprocess to run bcftools filtering
-    """
-    flagged_vcf = os.path.join(TEST_DATA_DIR, TEST_FLAGGED_VCF)
-    filter_command = (
-        "bcftools filter --soft-filter \"EXCLUDE\" -m + "
-        "-e '(CSQ_Consequence~\"synonymous_variant\")'"
-    )
-    filter_vcf = (
-        f"{Path(flagged_vcf).stem.split('.')[0]}.optimised_filtered.vcf"
-    )
+    def fail_split(self, input_vcf, log):
+        """
+        Stand in for bcftools +split-vep which exits straight away with an
+        error, as for a VCF with no CSQ field
+        """
+        return [
+            subprocess.Popen(
+                "echo '[E::split-vep] The tag CSQ not found' >&2; exit 1",
+                shell=True, stdout=subprocess.PIPE, stderr=log
+            )
+        ]
 
-    def test_bcftools_filter_creates_file(self):
+    def fail_filter_on_empty_input(self, filter_command, filter_vcf, log):
         """
-        Test that bcftools filter output file exists
+        Stand in for bcftools filter which fails if stdin is empty, and
+        otherwise discards the streamed VCF
         """
-        vcf.bcftools_filter(
-            self.flagged_vcf, self.filter_command, self.filter_vcf
+        return subprocess.Popen(
+            "if [ -z \"$(head -c 1)\" ]; then echo 'Failed to read from "
+            "standard input: unknown file type' >&2; exit 255; fi; "
+            "cat > /dev/null",
+            shell=True, stdin=subprocess.PIPE, stderr=log
         )
 
-        # Check exists
-        assert os.path.exists(
-            self.filter_vcf
-        ), "bcftools filter output file does not exist"
+    def test_add_annotation_streams_flagged_variants(self):
+        """
+        Test that all variants are streamed through to the output with the
+        MOI field added
+        """
+        with patch.object(
+            vcf, 'bcftools_pre_process', self.stream_split_vcf
+        ), patch.object(
+            vcf, 'bcftools_filter', self.write_streamed_vcf
+        ), patch.object(vcf, 'count_variants') as mock_count:
+            vcf.add_annotation(
+                'test.vcf.gz', self.test_panel_dict, 'filter_command'
+            )
 
-        # Remove file so doesn't affect test if run again in future
-        os.remove(self.filter_vcf)
+        output_mois = [
+            variant.info['MOI'] for variant in VariantFile(self.output_vcf)
+        ]
+        os.remove(self.output_vcf)
 
+        assert len(output_mois) == 255 and output_mois.count(('AR',)) == 2, (
+            "Flagged variants not streamed to output as expected"
+        )
+        assert not mock_count.called, (
+            "Variants counted in input and output VCFs without check_counts"
+        )
 
-    @patch('utils.vcf.subprocess.run')
-    def test_bcftools_filter_raises_error_if_return_code_not_zero(
-        self, mock_subprocess
-    ):
+    def test_add_annotation_raises_error_if_variants_lost(self):
         """
-        Test assertion error raised if return code of bcftools filter not zero
+        Test assertion error raised if variants are lost following bcftools
+        +split-vep
         """
-        mock_subprocess.return_value.returncode = 2
+        with patch.object(
+            vcf, 'bcftools_pre_process', self.stream_split_vcf
+        ), patch.object(
+            vcf, 'bcftools_filter', self.write_streamed_vcf
+        ), patch.object(vcf, 'count_variants', side_effect=[300, 255]):
+            with pytest.raises(AssertionError, match='fewer than the input'):
+                vcf.add_annotation(
+                    'test.vcf.gz', self.test_panel_dict, 'filter_command',
+                    check_counts=True
+                )
 
-        with pytest.raises(AssertionError):
-            vcf.bcftools_filter('flag_vcf', 'filter_command', 'filter_vcf')
+        os.remove(self.output_vcf)
 
-    @patch('utils.vcf.subprocess.run')
-    def test_bcftools_filter_raises_error_if_variant_counts_not_match(
-        self, mock_subprocess
-    ):
+    def test_add_annotation_raises_error_if_filter_counts_not_match(self):
         """
         Test assertion error raised if variant counts pre- and post-bcftools
         filter do not match
         """
-        mock_subprocess.side_effect = [
-            Mock(stdout=b'14'), Mock(returncode=0), Mock(stdout=b'5')
-        ]
+        with patch.object(
+            vcf, 'bcftools_pre_process', self.stream_split_vcf
+        ), patch.object(
+            vcf, 'bcftools_filter', self.write_streamed_vcf
+        ), patch.object(vcf, 'count_variants', side_effect=[255, 5]):
+            with pytest.raises(AssertionError, match='do not match'):
+                vcf.add_annotation(
+                    'test.vcf.gz', self.test_panel_dict, 'filter_command',
+                    check_counts=True
+                )
+
+        os.remove(self.output_vcf)
+
+    def test_add_annotation_raises_filter_error_if_filter_fails(
+            self, tmp_path
+        ):
+        """
+        Test that an error from bcftools filter partway through the stream
+        is raised with its stderr, rather than the upstream stages hanging
+        """
+        # Write out the split test VCF followed by enough copies of its first
+        # variant to fill the pipe
+        with open(self.split_vcf, encoding='utf8') as split_vcf:
+            lines = split_vcf.readlines()
+        first_variant = next(
+            line for line in lines if not line.startswith('#')
+        )
+        self.large_split_vcf = tmp_path / 'large_split.vcf'
+        self.large_split_vcf.write_text(
+            ''.join(lines) + first_variant * 50000, encoding='utf8'
+        )
 
-        with pytest.raises(AssertionError):
-            vcf.bcftools_filter('flag_vcf', 'filter_command', 'filter_vcf')
+        with patch.object(
+            vcf, 'bcftools_pre_process', self.stream_large_split_vcf
+        ), patch.object(vcf, 'bcftools_filter', self.fail_filter):
+            with pytest.raises(
+                AssertionError, match='could not parse the expression'
+            ):
+                vcf.add_annotation(
+                    'test.vcf.gz', self.test_panel_dict, 'filter_command'
+                )
+
+    def test_add_annotation_raises_split_error_if_split_fails(self):
+        """
+        Test that an error from bcftools +split-vep is raised with its stderr,
+        rather than the error from bcftools filter being left with no input
+        """
+        with patch.object(
+            vcf, 'bcftools_pre_process', self.fail_split
+        ), patch.object(
+            vcf, 'bcftools_filter', self.fail_filter_on_empty_input
+        ):
+            with pytest.raises(
+                AssertionError, match='The tag CSQ not found'
+            ):
+                vcf.add_annotation(
+                    'test.vcf.gz', self.test_panel_dict, 'filter_command'
+                )
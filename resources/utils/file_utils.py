@@ -2,6 +2,7 @@
 General functions which are shared between files
 """
 import json
+import orjson
 
 
 def read_in_json(file_name):
@@ -17,8 +18,10 @@ def read_in_json(file_name):
     json_dict : dict
         the JSON converted to a Python dictionary
     """
-    with open(file_name, "r", encoding='utf8') as json_file:
-        json_dict = json.load(json_file)
+    # Parse with orjson as it is several times faster than json at parsing
+    # large files such as the PanelApp dump
+    with open(file_name, "rb") as json_file:
+        json_dict = orjson.loads(json_file.read())
 
     return json_dict
 
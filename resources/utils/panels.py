@@ -1,13 +1,32 @@
 """
 Functions related to gene panels and obtaining information from PanelApp
 """
-import re
-
 from collections import defaultdict
 
 from .file_utils import read_in_json
 
 
+# Start of each PanelApp mode of inheritance and the simplified term for it.
+# These are plain prefix checks, so str.startswith is used rather than regex
+MOI_PREFIXES = (
+    ('BIALLELIC', 'AR'),
+    ('MONOALLELIC', 'AD'),
+    ('X-LINKED: hemizygous mutation in males, biallelic', 'XLR'),
+    ('X-LINKED: hemizygous mutation in males, monoallelic', 'XLD'),
+    ('BOTH', 'AD/AR'),
+    ('MITOCHONDRIAL', 'MITOCHONDRIAL'),
+    ('Other', 'OTHER'),
+    ('Unknown', 'UNKNOWN')
+)
+
+# Key of each entity list in a PanelApp panel, the key holding each entity's
+# name and the entity type to record for it
+PANEL_ENTITIES = (
+    ('genes', 'gene_symbol', 'gene'),
+    ('regions', 'name', 'region')
+)
+
+
 def parse_genepanels(genepanels_file):
     """
     Parse the genepanels file to make a dict mapping each clinical indication
@@ -29,6 +48,8 @@ def parse_genepanels(genepanels_file):
     ------
     AssertionError
         Raised if multiple panel IDs are found for one clinical indication
+    ValueError
+        Raised if a line of the genepanels file does not have 4 columns
 
     Example return format:
     {
@@ -36,14 +57,21 @@ def parse_genepanels(genepanels_file):
         'R130.1_Short QT syndrome_P': {'224'}
     }
     """
-    panel_data = {}
+    panel_data = defaultdict(set)
 
     # Open the file and read the TSV into a dict with each clinical indication
-    # and a set of the panel IDs associated with it
+    # and a set of the panel IDs associated with it. Only the first (clinical
+    # indication) and last (panel ID) columns are split out of each line
     with open(genepanels_file, encoding="utf-8") as gp_file:
         for line in gp_file:
-            clin_ind, panel, gene, panel_id = line.split('\t')
-            panel_data.setdefault(clin_ind, set()).add(panel_id.strip('\n'))
+            if line.count('\t') != 3:
+                raise ValueError(
+                    "Genepanels line does not have 4 tab-separated columns: "
+                    f"{line!r}"
+                )
+            clin_ind = line.split('\t', 1)[0]
+            panel_id = line.rpartition('\t')[2].strip('\n')
+            panel_data[clin_ind].add(panel_id)
 
     # Get any panels which have more than 1 PanelApp ID in genepanels file
     duplicate_ids = {k: sorted(v) for k, v in panel_data.items() if len(v) > 1}
@@ -86,12 +114,11 @@ def get_panel_id_from_genepanels(panel_string, genepanels_dict):
     panel_set = genepanels_dict.get(panel_string)
     # If panel ID exists for the panel string
     if panel_set:
-        panel_ids = list(panel_set)
-        assert len(panel_ids) < 2, (
+        assert len(panel_set) < 2, (
             f"Multiple panel IDs found for panel string: {panel_string}"
         )
-        # Get the only panel ID value in the list
-        panel_id = panel_ids[0]
+        # Get the only panel ID value in the set
+        panel_id = next(iter(panel_set))
         if not panel_id:
             print(
                 f"WARNING: Panel {panel_string} has no PanelApp ID in the "
@@ -178,18 +205,16 @@ def transform_panelapp_dump_to_dict(panel_dump):
             }, ..
     }
     """
-    # Get list of all the panel IDs for zipping
-    panel_ids = []
+    # Create new dict with panel ID as key in a single pass over the dump, so
+    # each panel can then be looked up by ID without scanning the whole dump
+    panel_id_dict = {}
     for panel in panel_dump:
         panel_id = panel.get('external_id')
         if panel_id:
-            panel_ids.append(str(panel_id))
+            panel_id_dict[str(panel_id)] = panel
         else:
             print(f"Panel did not have external ID key present: {panel}")
 
-    # Create new dict with panel ID as key
-    panel_id_dict = dict(zip(panel_ids, panel_dump))
-
     # Raise error if the panel ID dict is empty
     if not panel_id_dict:
         raise AssertionError("No panels with IDs found in PanelApp dump")
@@ -241,29 +266,22 @@ def format_panel_info(panel_data) -> dict:
     panel_dict : dict
         dict with each gene, its symbol, MOI and entity type
     """
-    panel_dict = defaultdict(dict)
+    panel_dict = {}
     if panel_data:
-        genes = panel_data.get('genes')
-        regions = panel_data.get('regions')
-        if genes:
-            for gene in genes:
-                gene_symbol = gene.get('gene_symbol')
-                moi = gene.get('mode_of_inheritance')
-                conf_level = int(gene.get('confidence_level'))
-                if conf_level >= 3:
-                    panel_dict[gene_symbol]['mode_of_inheritance'] = moi
-                    panel_dict[gene_symbol]['entity_type'] = 'gene'
-        if regions:
-            for region in regions:
-                region_name = region.get('name')
-                conf_level = int(region.get('confidence_level'))
-                moi = region.get('mode_of_inheritance')
+        # Genes and regions are handled in the same loop, differing only in
+        # the key holding their name and the entity type recorded
+        for entity_key, name_key, entity_type in PANEL_ENTITIES:
+            for entity in panel_data.get(entity_key) or ():
                 # conf_level 3 indicates sufficient gene-disease association
                 # evidence for use in variant interpretation (3 is green, 2
                 # amber, 1 red)
-                if conf_level >= 3:
-                    panel_dict[region_name]['mode_of_inheritance'] = moi
-                    panel_dict[region_name]['entity_type'] = 'region'
+                if int(entity.get('confidence_level')) >= 3:
+                    panel_dict[entity.get(name_key)] = {
+                        'mode_of_inheritance': entity.get(
+                            'mode_of_inheritance'
+                        ),
+                        'entity_type': entity_type
+                    }
     else:
         print("WARNING - panel-specific dictionary from PanelApp is empty")
 
@@ -279,42 +297,31 @@ def simplify_MOI_terms(panel_dict) -> dict:
     Parameters
     ----------
     panel_dict : dict
-        default dict with each gene on the panel as key and the gene info as val
+        dict with each gene on the panel as key and the gene info as val
 
     Returns
     -------
     updated_gene_dict : dict
-        default dict with each gene on the panel as key and the gene info (
+        dict with each gene on the panel as key and the gene info (
         including simplified MOI) as val
     """
-    updated_gene_dict = defaultdict(dict)
+    updated_gene_dict = {}
     for gene, moi_info in panel_dict.items():
         moi = moi_info.get('mode_of_inheritance')
+        # Get the term for the first prefix the MOI starts with, or NONE if
+        # the MOI is not a known term. Missing (None) or empty MOIs skip
+        # the prefix checks entirely
+        updated_moi = 'NONE'
         if moi:
-            xlr = "X-LINKED: hemizygous mutation in males, biallelic"
-            xld = "X-LINKED: hemizygous mutation in males, monoallelic"
-            if re.search(r"^BIALLELIC", moi):
-                updated_moi = 'AR'
-            elif re.search(r"^MONOALLELIC", moi):
-                updated_moi = 'AD'
-            elif re.search(r"^"+xlr, moi):
-                updated_moi = 'XLR'
-            elif re.search(r"^"+xld, moi):
-                updated_moi = 'XLD'
-            elif re.search(r"^BOTH", moi):
-                updated_moi = 'AD/AR'
-            elif re.search(r"^MITOCHONDRIAL", moi):
-                updated_moi = 'MITOCHONDRIAL'
-            elif re.search(r"^Other", moi):
-                updated_moi = 'OTHER'
-            elif re.search(r"^Unknown", moi):
-                updated_moi = 'UNKNOWN'
-            else:
-                updated_moi = 'NONE'
-        else:
-            updated_moi = 'NONE'
+            updated_moi = next(
+                (
+                    term for prefix, term in MOI_PREFIXES
+                    if moi.startswith(prefix)
+                ),
+                'NONE'
+            )
 
-        updated_gene_dict[gene]['mode_of_inheritance'] = updated_moi
+        updated_gene_dict[gene] = {'mode_of_inheritance': updated_moi}
 
     return updated_gene_dict
 
@@ -335,7 +342,7 @@ def get_formatted_dict(panel_string, genepanels_file, panelapp_file):
     Returns
     -------
     final_panel_dict : dict
-        default dict with each gene on the panel as key and the gene info as val
+        dict with each gene on the panel as key and the gene info as val
     """
     # Call functions to get PanelApp data from dump for given panel
     # and parse out the gene and region info
@@ -2,9 +2,11 @@
 Functions related to reading, processing and writing the VCF
 """
 import os
+import shlex
+import signal
 import subprocess
+import tempfile
 
-from collections import defaultdict
 from pathlib import Path
 from pysam import VariantFile
 
@@ -12,174 +14,156 @@ from pysam import VariantFile
 # Get path of parent directory
 ROOT_DIR = Path(__file__).absolute().parents[1]
 
+# INFO keys and default value for the MOI field, pre-encoded as bytes so that
+# pysam does not have to re-encode them for every variant record it accesses
+MOI_KEY = b'MOI'
+NO_MOI = b'NONE'
+SYMBOL_KEY = b'CSQ_SYMBOL'
 
-def bgzip(file) -> None:
+
+def count_variants(vcf_file) -> int:
     """
-    Call bgzip on a given file
+    Count the number of variant records (i.e. non-header lines) in a VCF
 
     Parameters
     ----------
-    file : file to compress
+    vcf_file : str
+        path to the VCF to count, may be gzipped
 
-    Outputs
+    Returns
     -------
-    compressed file
-
-    Raises
-    ------
-    AssertionError
-        Raised when non-zero exit code returned by bgzip
+    int
+        number of variant records in the VCF
     """
-    print(f"Calling bgzip on {file}")
-
+    # grep -c counts the non-header lines itself, so no shell or wc is needed
     output = subprocess.run(
-        f"bgzip --force {file} -c > {file}.gz",
-        shell=True,
+        ['zgrep', '-vc', '^#', vcf_file],
         capture_output=True
     )
 
-    assert output.returncode == 0, (
-        f"\n\tError in compressing file with bgzip. File: {file}"
-        f"\n\tExitcode:{output.returncode}"
-        f"\n\t{output.stderr.decode()}"
-    )
+    return int(output.stdout.decode())
 
 
-def bcftools_pre_process(input_vcf) -> str:
+def bcftools_pre_process(input_vcf, log) -> list:
     """
     Decompose multiple transcript annotations to individual records, and split
     VEP CSQ string fields to individual INFO keys. Adds a 'CSQ_' prefix to
     these fields to stop potential conflicts with existing INFO fields. Then
-    strips the original INFO/CSQ fields
+    strips the original INFO/CSQ fields. The split records are streamed to
+    stdout as uncompressed BCF rather than being written to disk
 
     Parameters
     ----------
     input_vcf : file
         path to VCF file to be split
+    log : file
+        file object which stderr of bcftools is written to
 
     Returns
     -------
-    output_vcf : str
-        name of VCF split by bcftools
-
-    Raises
-    ------
-    AssertionError
-        Raised when non-zero exit code returned by bcftools or output VCF
-        is truncated (fewer variants than were in input VCF)
+    processes : list
+        the running bcftools processes, the last of which has the split VCF
+        as its stdout
     """
-
     print(
         f"Splitting necessary fields from {input_vcf} "
         "with bcftools +split-vep"
     )
-    output_vcf = f"{Path(input_vcf).stem.split('.')[0]}.split.vcf"
 
-    # Check total rows before splitting out columns
-    pre_split_total = subprocess.run(
-        f"zgrep -v '^#' {input_vcf} | wc -l",
-        shell=True,
-        capture_output=True
-    )
     # Split out all fields from the CSQ string and name them with
-    # 'CSQ_{field}' as separate INFO fields. Remove original CSQ string
-    cmd = (
-        f"bcftools +split-vep --columns - -a CSQ -Ou -p 'CSQ_'"
-        f" -d {input_vcf} | bcftools annotate -x INFO/CSQ -o {output_vcf}"
+    # 'CSQ_{field}' as separate INFO fields
+    split_process = subprocess.Popen(
+        [
+            'bcftools', '+split-vep', '--columns', '-', '-a', 'CSQ', '-Ou',
+            '-p', 'CSQ_', '-d', input_vcf
+        ],
+        stdout=subprocess.PIPE,
+        stderr=log
     )
 
-    output = subprocess.run(cmd, shell=True, capture_output=True)
-
-    assert output.returncode == 0, (
-        f"\n\tError in splitting VCF with bcftools +split-vep. VCF: {input_vcf}"
-        f"\n\tExitcode:{output.returncode}"
-        f"\n\t{output.stderr.decode()}"
+    # Remove original CSQ string, reading straight from the split stream
+    annotate_process = subprocess.Popen(
+        ['bcftools', 'annotate', '-x', 'INFO/CSQ', '-Ou'],
+        stdin=split_process.stdout,
+        stdout=subprocess.PIPE,
+        stderr=log
     )
 
-    # Check total rows after splitting
-    post_split_total = subprocess.run(
-        f"zgrep -v '^#' {output_vcf} | wc -l",
-        shell=True,
-        capture_output=True
-    )
+    # Close our copy of the split stream, so only bcftools annotate reads it
+    split_process.stdout.close()
 
-    pre_split = pre_split_total.stdout.decode()
-    post_split = post_split_total.stdout.decode()
+    return [split_process, annotate_process]
 
-    print(
-        f"Total lines before splitting: {pre_split}"
-        f"Total lines after splitting: {post_split}"
-    )
-
-    assert int(post_split) >= int(pre_split), (
-        "Count of variants following bcftools +split-vep is fewer than the "
-        "input VCF"
-    )
 
-    return output_vcf
-
-
-def bcftools_filter(split_vcf, filter_command, filter_vcf):
+def bcftools_filter(filter_command, filter_vcf, log) -> subprocess.Popen:
     """
-    Filter the given VCF using bcftools command provided
+    Filter the VCF streamed to stdin using the bcftools command provided,
+    writing out the result as a compressed VCF
 
     Parameters
     ----------
-    split_vcf : pathlib.PosixPath
-        path to vcf file to filter
     filter_command : str
         the full bcftools filter command
     filter_vcf : str
-        name for output filtered vcf
+        name for output filtered (compressed) vcf
+    log : file
+        file object which stderr of bcftools is written to
+
+    Returns
+    -------
+    process : subprocess.Popen
+        the running bcftools process, reading the VCF to filter from stdin
 
     Outputs
     -------
     filter_vcf : file
         vcf file with PASS/EXCLUDE added to FILTER columns
-    Raises
-    ------
-    AssertionError
-        Raised when non-zero exit code returned by bcftools or number of
-        variants after filtering does not match input VCF
     """
-    command = f"{filter_command} {split_vcf} -o {filter_vcf}"
+    # Split the command into arguments the way the shell would, without
+    # starting a shell to run it
+    # bgzip compression is done by bcftools itself, with a thread for each
+    # CPU available to the job so it follows the instance type it runs on
+    threads = len(os.sched_getaffinity(0))
+    command = shlex.split(filter_command) + [
+        '-Oz', '--threads', str(threads), '-o', filter_vcf, '-'
+    ]
 
     print(
-        f"\nFiltering {split_vcf} with the command: \n\t{command}\n"
+        f"\nFiltering with the command: \n\t{shlex.join(command)}\n"
     )
 
-    pre_filter_total = subprocess.run(
-        f"zgrep -v '^#' {split_vcf} | wc -l",
-        shell=True,
-        capture_output=True
+    return subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stderr=log
     )
 
-    output = subprocess.run(command, shell=True, capture_output=True)
 
-    assert output.returncode == 0, (
-        f"\n\tError in filtering VCF with bcftools\n"
-        f"\n\tVCF: {split_vcf}\n"
-        f"\n\tExitcode:{output.returncode}\n"
-        f"\n\tbcftools filter command used: {filter_command}\n"
-        f"\n\t{output.stderr.decode()}"
-    )
-
-    post_filter_total = subprocess.run(
-        f"zgrep -v '^#' {filter_vcf} | wc -l",
-        shell=True,
-        capture_output=True
-    )
+def check_process(process, log, description) -> None:
+    """
+    Wait for a streaming process to finish and check that it succeeded
 
-    pre_filter = pre_filter_total.stdout.decode()
-    post_filter = post_filter_total.stdout.decode()
+    Parameters
+    ----------
+    process : subprocess.Popen
+        the process to wait for
+    log : file
+        file object which stderr of the process was written to
+    description : str
+        short description of what the process was doing, for the error
 
-    print(
-        f"Total lines before filtering: {pre_filter}"
-        f"Total lines after filtering: {post_filter}"
-    )
+    Raises
+    ------
+    AssertionError
+        Raised when non-zero exit code returned by the process
+    """
+    process.wait()
+    log.seek(0)
 
-    assert pre_filter == post_filter, (
-        "Number of variants before and after bcftools filter do not match"
+    assert process.returncode == 0, (
+        f"\n\tError in {description}"
+        f"\n\tExitcode:{process.returncode}"
+        f"\n\t{log.read().decode()}"
     )
 
 
@@ -190,9 +174,9 @@ def read_in_vcf(vcf_file):
 
     Parameters
     ----------
-    vcf_file : string
-        name of the annotated VCF file to be checked against filtering
-        parameters
+    vcf_file : string or file object
+        name of (or stream containing) the annotated VCF file to be checked
+        against filtering parameters
 
     Returns
     -------
@@ -201,7 +185,7 @@ def read_in_vcf(vcf_file):
     sample_name : str
         the full name of the sample
     """
-    print(f"Reading in the split VCF {vcf_file} with pysam")
+    print("Reading in the split VCF with pysam")
 
     # Read in and create pysam object of the VCF
     vcf_contents = VariantFile(vcf_file, 'r')
@@ -209,229 +193,204 @@ def read_in_vcf(vcf_file):
     # Get the name of the sample from the VCF
     sample_name = list(vcf_contents.header.samples)[0]
 
-    # Add MOI as INFO field
-    vcf_contents.header.info.add(
-        "MOI", ".", "String",
-        "Mode of inheritance from PanelApp (simplified)"
-    )
+    # Add MOI as INFO field before any records are read, unless the VCF has
+    # already been through the app (pysam raises if the ID already exists)
+    if "MOI" not in vcf_contents.header.info:
+        vcf_contents.header.info.add(
+            "MOI", ".", "String",
+            "Mode of inheritance from PanelApp (simplified)"
+        )
 
     return vcf_contents, sample_name
 
 
-def add_MOI_field(vcf_contents, panel_dict) -> dict:
+def add_MOI_field(vcf_contents, panel_dict):
     """
-    Add MOI INFO field to each variant which will be used for filtering
+    Add MOI INFO field to each variant which will be used for filtering.
+    Variants are yielded one at a time as they are read in, so the whole
+    VCF is never held in memory
 
     Parameters
     ----------
     vcf_contents : pysam.VariantFile object
         pysam object containing all the VCF's info
     panel_dict : dict
-        default dict with gene symbol as key and gene info as val
+        dict with gene symbol as key and gene info as val
 
-    Returns
-    -------
-    gene_variant_dict : dict
-        dictionary of each gene with value as a list of all variants in that
-        gene (plus additional INFO field)
+    Yields
+    ------
+    variant : pysam.VariantRecord
+        each variant (plus additional INFO field) in the same order as they
+        were read in, so the VCF written out stays sorted
     """
-    # Add each variant in a gene/entity to a dict, with gene as key and list
-    # of variants as value
-    gene_variant_dict = defaultdict(list)
-    for variant_record in vcf_contents:
-        gene = variant_record.info['CSQ_SYMBOL'][0]
-        gene_variant_dict[gene].append(variant_record)
-
-    # For each gene, check whether certain gene info is available
-    for gene, variant_list in gene_variant_dict.items():
-        gene_present = gene_moi = False
-        if gene in panel_dict:
-            gene_present = True
-            gene_moi = panel_dict[gene].get('mode_of_inheritance')
-
-        # Iterate over all of the variants called in that gene
-        # If gene present in our panel_dict and gene_moi is present,
-        # add the MOI we've taken from PanelApp to variant info
-        # otherwise set it to unknown
-        for variant in variant_list:
-            if all([gene_present, gene_moi]):
-                variant.info['MOI'] = gene_moi
-            else:
-                variant.info['MOI'] = 'NONE'
-
-    return gene_variant_dict
-
-
-def write_out_flagged_vcf(flagged_vcf, gene_variant_dict, vcf_contents):
+    # Get the encoded MOI of each gene in our panel_dict which has one up
+    # front, so that nothing about the gene has to be checked per variant
+    gene_mois = {
+        gene: gene_info['mode_of_inheritance'].encode()
+        for gene, gene_info in panel_dict.items()
+        if gene_info.get('mode_of_inheritance')
+    }
+
+    # If gene present in our panel_dict with an MOI, add the MOI we've taken
+    # from PanelApp to variant info otherwise set it to unknown. The INFO
+    # proxy and dict lookup are bound to locals as this runs for every variant
+    get_gene_moi = gene_mois.get
+    for variant in vcf_contents:
+        info = variant.info
+        info[MOI_KEY] = get_gene_moi(info[SYMBOL_KEY][0], NO_MOI)
+
+        yield variant
+
+
+def write_out_flagged_vcf(
+        flagged_vcf, flagged_variants, vcf_contents
+    ) -> int:
     """
-    Write out each variant record to VCF using pysam
+    Write out each variant record as uncompressed BCF using pysam
 
     Parameters
     ----------
-    flagged_vcf : str
-        Name of the VCF to be written out with flags added
-    gene_variant_dict : dict
-        dictionary with each gene and value as all of the variants in that gene
-        as list
+    flagged_vcf : str or file object
+        Name of (or stream for) the VCF to be written out with flags added
+    flagged_variants : iterable
+        all of the variants with the MOI INFO field added
     vcf_contents : pysam.VariantFile object
         the contents of the VCF as a pysam object
-    """
-    print(f"Writing out flagged variants to VCF: {flagged_vcf}")
 
-    with VariantFile(flagged_vcf, 'w', header=vcf_contents.header) as out_vcf:
-        # For each gene, write out each variant to VCF with extra INFO field
-        for gene, variant_list in gene_variant_dict.items():
-            for variant in variant_list:
-                out_vcf.write(variant)
-
-
-def check_written_out_vcf(
-        original_vcf_contents, gene_variant_dict, flagged_vcf
-    ):
+    Returns
+    -------
+    total : int
+        number of variants written out
     """
-    Check that the VCF file written out is exactly the same as the header
-    and dict of pysam variants that was meant to be written
+    print("Writing out flagged variants with pysam")
 
-    Parameters
-    ----------
-    original_vcf_contents : pysam.VariantFile object
-        the pysam object which was to be written to file
-    gene_variant_dict : dict
-        dictionary with each gene and value as all of the variants in that gene
-        as list
-    flagged_vcf : file
-        the VCF that was written out to be read back in with pysam
-    Raises
-    ------
-    AssertionError
-        Raised if the contents of the VCF which was to be written out does
-        not match the VCF which was actually written out
-    """
-    # Read in the VCF (that was just written out) back in with pysam
-    flagged_contents = VariantFile(flagged_vcf, 'r')
-
-    # Get list of lines in original header that was written out
-    # Get list of variant records which were to be written out
-    # Make one big list for original VCF contents which were to be written out
-    original_header = list(set(
-        str(header) for header in original_vcf_contents.header.records
-    ))
-    original_records = [
-        str(var) for variant_list in gene_variant_dict.values()
-        for var in variant_list
-    ]
-    original_contents = original_header + original_records
-
-    # Get list of lines which were written out to VCF file header
-    # Get list of variant records which were in the written out VCF
-    # Make one big list for written out VCF
-    written_header = list(set(
-        str(header) for header in flagged_contents.header.records
-    ))
-    written_records = [
-        str(variant_record) for variant_record in flagged_contents
-    ]
-    written_contents = written_header + written_records
+    total = 0
+    with VariantFile(
+        flagged_vcf, 'wb0', header=vcf_contents.header
+    ) as out_vcf:
+        # Write out each variant to VCF with extra INFO field
+        for variant in flagged_variants:
+            out_vcf.write(variant)
+            total += 1
 
-    assert original_contents == written_contents, (
-        "Header and variants written to VCF not identical to those "
-        "intended to be written out"
-    )
+    return total
 
 
-def bcftools_sort(input_vcf):
+def add_annotation(input_vcf, panel_dict, filter_command, check_counts=False):
     """
-    Sort the VCF. As we write out variants in gene order, if a
-    variant is annotated to multiple genes/transcripts and split, we can end up
-    with the VCF not being sorted by position so this fixes that
+    Main function to take a VCF and add the INFO field required for filtering.
+    bcftools +split-vep, the MOI flagging and bcftools filter are run as one
+    stream, passing uncompressed BCF between them, so no intermediate VCFs
+    are written to disk
 
     Parameters
     ----------
     input_vcf : str
-        path to filtered VCF to sort
-    output_vcf : str
-        name of output sorted VCF
+        name of the input VCF
+    panel_dict : dict
+        dict with each gene on panel as key and the gene info as val
+    filter_command : str
+        full bcftools filter command
+    check_counts : bool
+        if True, count the variants in the input VCF and the output VCF to
+        check none are lost. Off by default as each count is an extra full
+        decompression of the VCF
 
     Outputs
     -------
-    {vcf}.sorted.vcf : file
-        sorted vcf file output from bcftools
-    """
-    print(f"Sorting flagged VCF {input_vcf} with bcftools sort")
-    output_vcf = f"{Path(input_vcf).stem.split('.')[0]}.sorted.vcf"
-
-    # Check total rows before running bcftools sort
-    pre_sort_total = subprocess.run(
-        f"zgrep -v '^#' {input_vcf} | wc -l",
-        shell=True,
-        capture_output=True
-    )
-
-    cmd = f"bcftools sort {input_vcf} -o {output_vcf}"
+    {prefix}.optimised_filtered.vcf.gz : file
+        compressed VCF with MOI field added and filtering applied
 
-    output = subprocess.run(cmd, shell=True, capture_output=True)
-
-    assert output.returncode == 0, (
-        f"\n\tError in sorting VCF with bcftools. VCF: {input_vcf}"
-        f"\n\tExitcode:{output.returncode}"
-        f"\n\t{output.stderr.decode()}"
-    )
-
-    # Check total rows after sorting
-    post_sort_total = subprocess.run(
-        f"zgrep -v '^#' {output_vcf} | wc -l",
-        shell=True,
-        capture_output=True
-    )
+    Raises
+    ------
+    AssertionError
+        Raised when non-zero exit code returned by bcftools, or (if
+        check_counts) if the count of variants is fewer after splitting than
+        in the input VCF or changes during flagging and filtering
+    """
+    prefix = Path(input_vcf).stem.split('.')[0]
+    filter_vcf = f"{prefix}.optimised_filtered.vcf.gz"
 
-    pre_sort = pre_sort_total.stdout.decode()
-    post_sort = post_sort_total.stdout.decode()
+    # Check total rows before splitting out columns
+    if check_counts:
+        pre_split = count_variants(input_vcf)
+
+    with tempfile.TemporaryFile() as split_log, \
+            tempfile.TemporaryFile() as filter_log:
+        # separate csq fields and run bcftools filter string from config
+        split_processes = bcftools_pre_process(input_vcf, split_log)
+        filter_process = bcftools_filter(
+            filter_command, filter_vcf, filter_log
+        )
+
+        vcf_contents = None
+        stream_failed = False
+        try:
+            # create pysam object of split vcf, add MOI flags from config and
+            # stream the flagged variants on to be filtered
+            vcf_contents, sample_name = read_in_vcf(
+                split_processes[-1].stdout
+            )
+            flagged_variants = add_MOI_field(vcf_contents, panel_dict)
+            post_split = write_out_flagged_vcf(
+                filter_process.stdin, flagged_variants, vcf_contents
+            )
+        except Exception:
+            stream_failed = True
+            raise
+        finally:
+            # pysam holds its own copy of the split stream, which must be
+            # closed too so the split processes are not left blocked writing
+            # to a pipe nothing is reading
+            if vcf_contents is not None:
+                vcf_contents.close()
+            split_processes[-1].stdout.close()
+            filter_process.stdin.close()
+
+            # Check the split stages first, as if one fails bcftools filter
+            # is left with no input and fails too, hiding the real error. A
+            # split stage killed by SIGPIPE only stopped because the stream
+            # stopped being read, so the error downstream is checked first
+            split_description = (
+                f"splitting VCF with bcftools +split-vep. VCF: {input_vcf}"
+            )
+            for split_process in split_processes:
+                split_process.wait()
+                if split_process.returncode != -signal.SIGPIPE:
+                    check_process(split_process, split_log, split_description)
+
+            check_process(
+                filter_process, filter_log,
+                f"filtering VCF with bcftools\n\tbcftools filter command "
+                f"used: {filter_command}"
+            )
+
+            # If nothing downstream failed, a split stage should never have
+            # been killed by SIGPIPE, so report it
+            if not stream_failed:
+                for split_process in split_processes:
+                    check_process(split_process, split_log, split_description)
+
+    # Variants are counted as they are written out, so the count after
+    # splitting is known without another pass over the VCF
+    print(f"Total lines after splitting: {post_split}\n")
+
+    if not check_counts:
+        return
+
+    # Check total rows after filtering
+    post_filter = count_variants(filter_vcf)
 
     print(
-        f"Total lines before sorting: {pre_sort}"
-        f"Total lines after sorting: {post_sort}"
+        f"Total lines before splitting: {pre_split}\n"
+        f"Total lines after filtering: {post_filter}\n"
     )
 
-    assert pre_sort == post_sort, (
-        "Count of variants before and after bcftools sort do not match"
+    assert post_split >= pre_split, (
+        "Count of variants following bcftools +split-vep is fewer than the "
+        "input VCF"
     )
 
-
-def add_annotation(input_vcf, panel_dict, filter_command):
-    """
-    Main function to take a VCF and add the INFO field required for filtering
-
-    Parameters
-    ----------
-    input_vcf : str
-        name of the input VCF
-    panel_dict : dict
-        default dict with each gene on panel as key and the gene info as val
-    filter_command : str
-        full bcftools filter command
-    """
-    split_vcf = f"{Path(input_vcf).stem.split('.')[0]}.split.vcf"
-    flagged_vcf = f"{Path(input_vcf).stem.split('.')[0]}.flagged.vcf"
-    sorted_vcf = f"{Path(input_vcf).stem.split('.')[0]}.sorted.vcf"
-    filter_vcf = f"{Path(input_vcf).stem.split('.')[0]}.optimised_filtered.vcf"
-
-    # separate csq fields (creates split_vcf)
-    bcftools_pre_process(input_vcf)
-
-    # create pysam object of vcf for flagging
-    vcf_contents, sample_name = read_in_vcf(split_vcf)
-
-    # add MOI flags from config
-    gene_var_dict = add_MOI_field(vcf_contents, panel_dict)
-    write_out_flagged_vcf(flagged_vcf, gene_var_dict, vcf_contents)
-    check_written_out_vcf(vcf_contents, gene_var_dict, flagged_vcf)
-    bcftools_sort(flagged_vcf)
-
-    # run bcftools filter string from config (create filter_vcf)
-    bcftools_filter(sorted_vcf, filter_command, filter_vcf)
-
-    bgzip(filter_vcf)
-    os.remove(split_vcf)
-    os.remove(flagged_vcf)
-    os.remove(sorted_vcf)
-    os.remove(filter_vcf)
+    assert post_split == post_filter, (
+        "Number of variants before and after bcftools filter do not match"
+    )
@@ -17,13 +17,18 @@ main() {
     # get inputs
     dx-download-all-inputs --parallel
 
+    # optionally count variants before and after to check none are lost
+    check_counts_arg=""
+    if [ "$check_counts" == 'true' ]; then check_counts_arg="--check_counts"; fi
+
     # run tool
     python3 /add_optimised_filtering.py \
         -i $input_vcf_path \
         -f "$filter_string" \
         -p "$panel_string" \
         -g $genepanels_path \
-        -d $panel_dump_path
+        -d $panel_dump_path \
+        $check_counts_arg
 
     # prepare outputs
     echo "All scripts finished successfully, uploading output files to dx"